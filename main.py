@@ -2,34 +2,1019 @@
 This is a proof of concept for using the new Entity API with DocumentCloud
 """
 
+import asyncio
+import base64
+import hashlib
+import json
 import logging
 import os
-import sys
+import queue
+import random
+import sqlite3
+import threading
+import time
+import zlib
 from bisect import bisect
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from tempfile import NamedTemporaryFile
+from urllib.parse import urlparse
 
-from documentcloud.addon import AddOn
+import requests
+from documentcloud.addon import SoftTimeOutAddOn
 from documentcloud.exceptions import APIError
 from documentcloud.exceptions import DoesNotExistError
 from documentcloud.toolbox import grouper
+from documentcloud.toolbox import requests_retry_session
+from google.api_core import exceptions as google_exceptions
 from google.cloud import language_v1
 from google.cloud.language_v1.types.language_service import AnalyzeEntitiesResponse
+from requests.adapters import HTTPAdapter
 from wikimapper import WikiMapper
 
+try:
+    import ijson
+except ImportError:  # pragma: no cover
+    ijson = None
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.WARNING)
 
 BYTE_LIMIT = 1000000
+# the entity extraction API bills per request for each 1,000 characters
+BILLING_UNIT = 1000
+# amount of text to plan chunks for at once
+PLAN_WINDOW = 3 * BYTE_LIMIT
+# the most items the API accepts in one bulk request
 BULK_LIMIT = 25
+# bounds in bytes for adaptively sized bulk requests, and the response time in
+# seconds to aim for
+BULK_MIN_BYTES = 64 * 1024
+BULK_START_BYTES = 512 * 1024
+BULK_MAX_BYTES = 2 * 1024 * 1024
+BULK_TARGET_SECONDS = 2
+# maximum page size supported by the DocumentCloud API
+PER_PAGE = 100
+# number of Wikidata IDs to look up per request, to keep the URL a safe length
+LOOKUP_LIMIT = 100
+# number of entity lookup requests to have in flight at once
+LOOKUP_WORKERS = 4
+WIKIMAPPER_DB = "data/index_enwiki-latest.db"
+# local database for caches.  The add-on runs on a fresh GitHub Actions runner,
+# whose reusable workflow has no step to keep this file, so the caches only last
+# for one run there, and only persist between runs where `data/` is kept, such as
+# when run locally
+CACHE_DB = "data/cache.db"
+# number of entity extraction responses to keep in the local cache
+NLP_CACHE_ENTRIES = 1000
+# bump this when the format of the cached responses changes
+NLP_CACHE_VERSION = 2
+# maximum number of bound parameters in a single SQLite query
+SQLITE_VARIABLE_LIMIT = 999
+# hex digits of each page's content hash to store, to tell which pages changed
+PAGE_HASH_LENGTH = 16
+# document data key holding the page hashes as of the last successful run, so
+# they are kept with the document rather than on the runner
+PAGE_HASH_KEY = "gcp_entities_page_hashes"
+# number of page hashes to pack into each document data value
+PAGE_HASHES_PER_VALUE = 1000
+# number of Wikipedia URL to Wikidata ID mappings to keep in memory
+WIKIDATA_CACHE_SIZE = 100000
+# number of worker threads for each pipeline stage, may be overridden with the
+# `max_workers` parameter
+MAX_WORKERS = 4
+# number of documents which may wait between pipeline stages
+QUEUE_SIZE = 2
+# number of chunks of a single document to analyze concurrently, may be
+# overridden with the `chunk_workers` parameter
+CHUNK_WORKERS = 4
+# Natural Language API quota, may be overridden with the `requests_per_minute`
+# and `characters_per_minute` parameters, `None` for no limit
+REQUESTS_PER_MINUTE = 600
+CHARACTERS_PER_MINUTE = None
+# seconds of quota which may be saved up and used at once
+RATE_LIMIT_BURST_SECONDS = 2
+# retries for transient failures: attempts per call, total retries per run
+# (may be overridden with the `retry_budget` parameter) and backoff in seconds
+RETRY_ATTEMPTS = 5
+RETRY_BUDGET = 200
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+# number of occurrence batches to post at once for a document, may be
+# overridden with the `post_workers` parameter
+POST_WORKERS = 4
+# number of connections to keep open to the DocumentCloud API
+POOL_SIZE = 32
+# document data key holding the entities extracted from each chunk of a document
+# which has not been finished, so that a run which stops part way does not pay
+# to extract them again
+CHECKPOINT_KEY = "gcp_entities_checkpoint"
+# characters of encoded entities to pack into each document data value
+CHECKPOINT_VALUE_SIZE = 16 * 1024
+# seconds for which a checkpoint is trusted
+CHECKPOINT_EXPIRY = 7 * 24 * 60 * 60
+# seconds after which the remaining documents are handed to a new run.  GitHub
+# Actions stops a job after six hours, and the documents already in flight are
+# finished before the new run starts
+SOFT_TIME_LIMIT = 4 * 60 * 60
+# number of failed documents to describe in the final message
+REPORTED_FAILURES = 10
+# number of requests to have in flight at once when running with the `asyncio`
+# parameter, may be overridden with the `max_concurrency` parameter
+MAX_CONCURRENCY = 16
+
+
+def split_text(text, limit):
+    """Split text into consecutive pieces of at most limit bytes when encoded as
+    utf8, preferring to break after a sentence, then at whitespace
+    """
+    pieces = []
+    start = 0
+    remaining = len(text.encode("utf8"))
+    while remaining > limit:
+        # the longest run of whole characters which fits in the limit
+        window = (
+            text[start : start + limit]
+            .encode("utf8")[:limit]
+            .decode("utf8", errors="ignore")
+        )
+        # only accept a break in the second half, to avoid tiny pieces
+        end = max(window.rfind(s) for s in (". ", "! ", "? ", "\n")) + 1
+        if end <= len(window) // 2:
+            end = max(window.rfind(s) for s in (" ", "\t")) + 1
+        if end <= len(window) // 2:
+            end = len(window)
+        pieces.append(text[start : start + end])
+        remaining -= len(pieces[-1].encode("utf8"))
+        start += end
+    pieces.append(text[start:])
+    return pieces
+
+
+def page_hash(page):
+    """A short hash of a page's text, to tell whether it has changed"""
+    return hashlib.sha256(page["contents"].encode("utf8")).hexdigest()[
+        :PAGE_HASH_LENGTH
+    ]
+
+
+def encode_page_hashes(page_hashes):
+    """Pack page hashes into document data values, numbered so they can be put
+    back in order
+    """
+    return [
+        f"{i}:{''.join(page_hashes[start : start + PAGE_HASHES_PER_VALUE])}"
+        for i, start in enumerate(range(0, len(page_hashes), PAGE_HASHES_PER_VALUE))
+    ]
+
+
+def decode_page_hashes(values):
+    """Inverse of `encode_page_hashes`"""
+    numbered = (value.split(":", 1) for value in values)
+    packed = "".join(hashes for _, hashes in sorted(numbered, key=lambda v: int(v[0])))
+    return [
+        packed[start : start + PAGE_HASH_LENGTH]
+        for start in range(0, len(packed), PAGE_HASH_LENGTH)
+    ]
+
+
+def encode_checkpoint(key, entities, saved):
+    """Pack the entities extracted from a chunk into document data values,
+    tagged with the chunk's key and the time they were saved, and numbered so
+    they can be put back together
+    """
+    payload = base64.urlsafe_b64encode(
+        zlib.compress(json.dumps([e.to_json() for e in entities]).encode("utf8"))
+    ).decode("ascii")
+    pieces = [
+        payload[start : start + CHECKPOINT_VALUE_SIZE]
+        for start in range(0, len(payload), CHECKPOINT_VALUE_SIZE)
+    ]
+    return [
+        f"{key}:{int(saved)}:{i}/{len(pieces)}:{piece}"
+        for i, piece in enumerate(pieces)
+    ]
+
+
+def decode_checkpoint(values, now):
+    """Inverse of `encode_checkpoint`, returning the entities in their JSON form
+    keyed by chunk.  Chunks saved more than `CHECKPOINT_EXPIRY` seconds ago,
+    or with values missing, are left out
+    """
+    pieces = {}
+    for value in values:
+        try:
+            key, saved, part, piece = value.split(":", 3)
+            index, count = part.split("/")
+            if now - int(saved) > CHECKPOINT_EXPIRY:
+                continue
+            pieces.setdefault((key, saved, int(count)), {})[int(index)] = piece
+        except ValueError:
+            continue
+    chunks = {}
+    for (key, _, count), parts in pieces.items():
+        if len(parts) != count:
+            continue
+        payload = "".join(parts.get(i, "") for i in range(count))
+        try:
+            chunks[key] = json.loads(zlib.decompress(base64.urlsafe_b64decode(payload)))
+        except (ValueError, zlib.error):
+            continue
+    return chunks
+
+
+def page_segments(pages, page_map, include=None):
+    """Yield the text of each page, its size in bytes and its character offset
+    into the document, splitting any page which is too large for the entity
+    extraction API on its own.  The start character of each page is appended to
+    `page_map`.  If given, only pages for which `include(index, page)` is true
+    are yielded.
+    """
+    for index, page in enumerate(pages):
+        text = page["contents"] + "\n\n"
+        # page map is stored in unicode characters
+        # we add the current page's length in characters to the beginning of the
+        # last page, to get the start character of the next page
+        character_offset = page_map[-1]
+        page_map.append(character_offset + len(text))
+        if include is not None and not include(index, page):
+            continue
+        # the API limit is based on byte size, so we use the length of the
+        # content encoded into utf8
+        page_bytes = len(text.encode("utf8"))
+        if page_bytes > BYTE_LIMIT:
+            logger.info("Splitting page %d of %d bytes", page["page"], page_bytes)
+            for piece in split_text(text, BYTE_LIMIT):
+                yield piece, len(piece.encode("utf8")), character_offset
+                character_offset += len(piece)
+        else:
+            yield text, page_bytes, character_offset
+
+
+def billed_units(characters):
+    """The number of units the entity extraction API bills for a request"""
+    return max(1, -(-characters // BILLING_UNIT))
+
+
+def plan_chunks(segments, limit=BYTE_LIMIT):
+    """Pack consecutive `(text, bytes, offset)` segments into chunks of at most
+    limit bytes, minimizing the number of requests and then the number of billed
+    units.  Returns the `(start, end)` range of segments in each chunk.
+    """
+    byte_sums = [0]
+    char_sums = [0]
+    for text, text_bytes, _ in segments:
+        byte_sums.append(byte_sums[-1] + text_bytes)
+        char_sums.append(char_sums[-1] + len(text))
+
+    # a chunk of segments j to i is billed
+    #   ceil((char_sums[i] - char_sums[j]) / BILLING_UNIT)
+    #   = whole[i] - whole[j] + (1 if part[j] < part[i] else 0)
+    # where whole and part are the quotient and remainder of the character sums.
+    # So the best start for a chunk ending at i has the fewest requests, then
+    # the lowest units - whole, then the highest part, and is kept at the front
+    # of a queue of the starts which fit, rather than scanning them all
+    request_counts = [0]
+    units = [0]
+    starts = [0]
+    candidates = deque()
+    first = 0
+    for i in range(1, len(segments) + 1):
+        whole, part = divmod(char_sums[i - 1], BILLING_UNIT)
+        key = (request_counts[i - 1], units[i - 1] - whole, -part)
+        # an earlier start with no better key can never be the best again
+        while candidates and candidates[-1][0] >= key:
+            candidates.pop()
+        candidates.append((key, i - 1))
+        while byte_sums[i] - byte_sums[first] > limit:
+            first += 1
+        while candidates[0][1] < first:
+            candidates.popleft()
+
+        (request_count, extra_units, start_part), start = candidates[0]
+        whole, part = divmod(char_sums[i], BILLING_UNIT)
+        request_counts.append(request_count + 1)
+        units.append(whole + extra_units + (1 if -start_part < part else 0))
+        starts.append(start)
+
+    chunks = []
+    end = len(segments)
+    while end > 0:
+        chunks.append((starts[end], end))
+        end = starts[end]
+    return chunks[::-1]
+
+
+def chunk_pages(pages, page_map, include=None):
+    """Group consecutive pages into chunks of text small enough for the entity
+    extraction API, yielding each chunk's text and the runs of the document it
+    covers, as `(chunk offset, document offset)` pairs.  There is more than one
+    run only when pages are left out with `include`, see `page_segments`.  The
+    start character of each page is appended to `page_map`.  Pages are planned a
+    window at a time, so long documents do not need to be held in full.
+    """
+    segments = []
+    window_bytes = 0
+
+    def join(chunks):
+        for start, end in chunks:
+            runs = []
+            length = 0
+            for text, _, character_offset in segments[start:end]:
+                # start a new run wherever the text skips part of the document
+                if not runs or runs[-1][1] + length - runs[-1][0] != character_offset:
+                    runs.append((length, character_offset))
+                length += len(text)
+            yield "".join(t for t, _, _ in segments[start:end]), runs
+
+    for segment in page_segments(pages, page_map, include):
+        segments.append(segment)
+        window_bytes += segment[1]
+        if window_bytes >= PLAN_WINDOW:
+            chunks = plan_chunks(segments)
+            # the last chunk may pack better with the pages still to come
+            yield from join(chunks[:-1])
+            segments = segments[chunks[-1][0] :]
+            window_bytes = sum(b for _, b, _ in segments)
+
+    yield from join(plan_chunks(segments))
+
+
+def log_plan(document, chunks):
+    """Report the bytes and billed units of each chunk as it is planned, and the
+    totals for the document once they have all been planned
+    """
+    total_bytes = 0
+    total_units = 0
+    count = 0
+    for count, (text, runs) in enumerate(chunks, 1):
+        chunk_bytes = len(text.encode("utf8"))
+        units = billed_units(len(text))
+        logger.info(
+            "Planned chunk %d for %s: %d bytes, %d billed units",
+            count,
+            document,
+            chunk_bytes,
+            units,
+        )
+        total_bytes += chunk_bytes
+        total_units += units
+        yield text, runs
+    logger.info(
+        "Planned %d chunks for %s: %d bytes, %d billed units",
+        count,
+        document,
+        total_bytes,
+        total_units,
+    )
+
+
+def stream_pages(response):
+    """Parse the pages out of a streamed JSON text response as they arrive"""
+    with response:
+        response.raw.decode_content = True
+        yield from ijson.items(response.raw, "pages.item")
+
+
+def locate_offsets(offsets, page_map):
+    """Find the page and the offset into the page for each character offset in
+    the document, using a single vectorized search if NumPy is available
+    """
+    if np is not None:
+        page_starts = np.asarray(page_map)
+        offsets = np.asarray(offsets, dtype=page_starts.dtype)
+        pages = np.searchsorted(page_starts, offsets, side="right") - 1
+        # convert back to python ints so they can be serialized to JSON
+        return list(zip(pages.tolist(), (offsets - page_starts[pages]).tolist()))
+    locations = []
+    for offset in offsets:
+        page = bisect(page_map, offset) - 1
+        locations.append((page, offset - page_map[page]))
+    return locations
+
+
+class Mention:
+    """A mention of an entity, with its character offset into the document"""
 
+    __slots__ = ("content", "offset")
 
-class GCPEntityExtractor(AddOn):
+    def __init__(self, content, offset):
+        self.content = content
+        self.offset = offset
+
+
+class Entity:
+    """An entity found in a document, with only the fields we persist"""
+
+    __slots__ = ("wikipedia_url", "wikidata_id", "salience", "mentions")
+
+    def __init__(self, wikipedia_url, salience, mentions):
+        self.wikipedia_url = wikipedia_url
+        self.wikidata_id = None
+        self.salience = salience
+        self.mentions = mentions
+
+    def to_json(self):
+        """Compact JSON serializable form, for caching"""
+        return [
+            self.wikipedia_url,
+            self.salience,
+            [[mention.content, mention.offset] for mention in self.mentions],
+        ]
+
+    @classmethod
+    def from_json(cls, data):
+        """Inverse of `to_json`"""
+        wikipedia_url, salience, mentions = data
+        return cls(wikipedia_url, salience, [Mention(*m) for m in mentions])
+
+
+def entities_from_response(response):
+    """Build entities for those with a Wikipedia URL, reading the protobuf
+    message directly so the entities we discard are never converted
+    """
+    entities = []
+    for entity in AnalyzeEntitiesResponse.pb(response).entities:
+        # only get entities with Wikipedia URLs for now
+        wikipedia_url = entity.metadata.get("wikipedia_url")
+        if wikipedia_url is None:
+            continue
+        entities.append(
+            Entity(
+                wikipedia_url,
+                entity.salience,
+                [
+                    Mention(mention.text.content, mention.text.begin_offset)
+                    for mention in entity.mentions
+                ],
+            )
+        )
+    return entities
+
+
+def offset_entities(entities, runs):
+    """Adjust the entities' mention offsets from the chunk to the document,
+    given the `(chunk offset, document offset)` runs the chunk covers
+    """
+    chunk_starts = [chunk_offset for chunk_offset, _ in runs]
+    for entity in entities:
+        for mention in entity.mentions:
+            chunk_offset, character_offset = runs[
+                bisect(chunk_starts, mention.offset) - 1
+            ]
+            mention.offset += character_offset - chunk_offset
+    return entities
+
+
+class DocumentError(Exception):
+    """A problem with a single document, which fails that document without
+    stopping the rest of the run.  The message is shown to the user
+    """
+
+
+class DocumentJob:
+    """A document's state as it moves through the pipeline stages"""
+
+    __slots__ = (
+        "document",
+        "page_map",
+        "entities",
+        "existing_entities",
+        "entity_map",
+        "occurrences",
+        "page_hashes",
+        "previous_hashes",
+        "changed_pages",
+        "updates",
+        "checkpoint",
+        "checkpointed",
+    )
+
+    def __init__(self, document):
+        self.document = document
+        self.page_map = [0]
+        self.entities = []
+        self.existing_entities = set()
+        self.entity_map = {}
+        self.occurrences = []
+        # content hashes of the pages, and those stored by the last successful
+        # run if there was one
+        self.page_hashes = []
+        self.previous_hashes = None
+        # the indexes of the pages which have changed since the last run, or
+        # `None` if every page is being extracted
+        self.changed_pages = None
+        # DocumentCloud entity ID to the replacement occurrences for entities
+        # already on the document, an empty list to remove them
+        self.updates = {}
+        # the entities extracted from each chunk by earlier runs which did not
+        # finish the document, and whether there is a checkpoint to remove once
+        # it is finished
+        self.checkpoint = {}
+        self.checkpointed = False
+
+    def set_previous_hashes(self, previous_hashes):
+        """Only extract the pages which have changed since these hashes were
+        stored
+        """
+        self.previous_hashes = previous_hashes
+        self.changed_pages = set()
+
+    def page_changed(self, index, page):
+        """Record the page's hash and whether it has changed since the last run"""
+        self.page_hashes.append(page_hash(page))
+        if self.previous_hashes is None:
+            return True
+        if (
+            index < len(self.previous_hashes)
+            and self.previous_hashes[index] == self.page_hashes[-1]
+        ):
+            return False
+        self.changed_pages.add(index)
+        return True
+
+    def pages_read(self):
+        """Count the pages which have been removed since the last run as changed,
+        once all of the pages have been read
+        """
+        if self.previous_hashes is not None:
+            self.changed_pages.update(
+                range(len(self.page_hashes), len(self.previous_hashes))
+            )
+
+
+class Pipeline:
+    """Pass jobs through a series of stages, each with its own worker threads,
+    connected by bounded queues, so that every stage can be busy with a
+    different job at once
+    """
+
+    STOP = object()
+
+    def __init__(self, stages, queue_size, on_success, on_error):
+        # a list of (name, function, number of workers)
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.on_success = on_success
+        self.on_error = on_error
+        # set if a stage raises something other than an Exception, such as
+        # KeyboardInterrupt, which stops the whole run
+        self.abort = None
+
+    def run(self, jobs):
+        """Feed the jobs into the first stage and wait for all of them to finish"""
+        threads = []
+        for i, (name, func, workers) in enumerate(self.stages):
+            outbox = self.queues[i + 1] if i + 1 < len(self.queues) else None
+            threads.append(
+                [
+                    threading.Thread(
+                        target=self._work,
+                        args=(func, self.queues[i], outbox),
+                        name=f"{name}-{n}",
+                        daemon=True,
+                    )
+                    for n in range(workers)
+                ]
+            )
+            for thread in threads[-1]:
+                thread.start()
+
+        for job in jobs:
+            if self.abort is not None:
+                break
+            self.queues[0].put(job)
+
+        # stop each stage once every stage before it has finished
+        for inbox, stage_threads in zip(self.queues, threads):
+            for _ in stage_threads:
+                inbox.put(self.STOP)
+            for thread in stage_threads:
+                thread.join()
+
+        if self.abort is not None:
+            raise self.abort
+
+    def _work(self, func, inbox, outbox):
+        """Run jobs from the inbox through func and pass them on to the outbox"""
+        while True:
+            job = inbox.get()
+            if job is self.STOP:
+                return
+            if self.abort is not None:
+                # drain the queue without doing any more work
+                continue
+            try:
+                func(job)
+                if outbox is None:
+                    self.on_success(job)
+            except Exception as exc:  # pylint: disable=broad-except
+                self._fail(job, exc)
+                continue
+            except BaseException as exc:  # pylint: disable=broad-except
+                self.abort = exc
+                continue
+            if outbox is not None:
+                outbox.put(job)
+
+    def _fail(self, job, exc):
+        """Pass a failed job to on_error.  If that fails too the error is only
+        logged, as a worker which dies would leave the stages before it blocked
+        """
+        try:
+            self.on_error(job, exc)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Error while handling a failed job")
+
+
+class PooledSession(requests.Session):
+    """A session whose connection pools survive python-documentcloud mounting
+    a fresh adapter before every request, so connections are reused between
+    requests and shared by the worker threads
+    """
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        super().__init__()
+
+    def mount(self, prefix, adapter):
+        existing = self.adapters.get(prefix)
+        if existing is not None:
+            # keep the pooled connections, but take the new retry settings
+            existing.max_retries = adapter.max_retries
+            return
+        super().mount(
+            prefix,
+            HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+                max_retries=adapter.max_retries,
+            ),
+        )
+
+
+class AdaptiveBatcher:
+    """Size batches for a bulk endpoint by their serialized size in bytes,
+    growing the target while the server responds quickly and shrinking it on
+    slow responses, timeouts and requests which are too large
+    """
+
+    def __init__(self):
+        self.target_bytes = BULK_START_BYTES
+        self.lock = threading.Lock()
+
+    def batches(self, items):
+        """Yield batches of items, sized by the target at the time each batch is
+        made, so later batches benefit from what earlier ones learned
+        """
+        batch = []
+        batch_bytes = 0
+        for item in items:
+            item_bytes = len(json.dumps(item))
+            if batch and (
+                len(batch) >= BULK_LIMIT or batch_bytes + item_bytes > self.target_bytes
+            ):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += item_bytes
+        if batch:
+            yield batch
+
+    def record(self, seconds, too_large=False):
+        """Adjust the target from how a request went"""
+        with self.lock:
+            if too_large:
+                self.target_bytes //= 2
+            elif seconds > 2 * BULK_TARGET_SECONDS:
+                self.target_bytes = self.target_bytes * 3 // 4
+            elif seconds < BULK_TARGET_SECONDS:
+                self.target_bytes = self.target_bytes * 5 // 4
+            self.target_bytes = min(
+                BULK_MAX_BYTES, max(BULK_MIN_BYTES, self.target_bytes)
+            )
+
+
+class LRUCache:
+    """A bounded, thread safe, least recently used cache which counts its hits
+    and misses
+    """
+
+    # returned by `get` on a miss, as `None` is a valid value to cache
+    MISSING = object()
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the value for key, or `MISSING` if it is not cached"""
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return self.MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+
+    def set(self, key, value):
+        """Cache the value for key, evicting the least recently used key if full"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class TokenBucket:
+    """A thread safe token bucket which refills continuously at its per minute
+    rate.  It starts empty and holds at most `RATE_LIMIT_BURST_SECONDS` of
+    tokens, so a run never sends more than the quota in its first minute, or
+    bursts after a pause.  Reservations may put the bucket into debt, so that
+    callers are spaced out in the order they reserved
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * RATE_LIMIT_BURST_SECONDS
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take amount tokens, returning how many seconds to wait before use"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """Client side limit on requests and characters per minute, shared by every
+    worker calling the entity extraction API
+    """
+
+    def __init__(self, requests_per_minute=None, characters_per_minute=None):
+        self.buckets = []
+        if requests_per_minute:
+            self.buckets.append((TokenBucket(requests_per_minute), lambda c: 1))
+        if characters_per_minute:
+            self.buckets.append((TokenBucket(characters_per_minute), lambda c: c))
+
+    def reserve(self, characters):
+        """Reserve quota for one request, returning how many seconds to wait"""
+        return max(
+            [bucket.reserve(cost(characters)) for bucket, cost in self.buckets],
+            default=0,
+        )
+
+    def wait(self, characters):
+        """Block until there is quota for a request of this many characters"""
+        delay = self.reserve(characters)
+        if delay:
+            logger.info("Waiting %.2f seconds for API quota", delay)
+            time.sleep(delay)
+
+    async def wait_async(self, characters):
+        """Wait until there is quota for a request of this many characters"""
+        delay = self.reserve(characters)
+        if delay:
+            logger.info("Waiting %.2f seconds for API quota", delay)
+            await asyncio.sleep(delay)
+
+
+class RetryPolicy:
+    """Retry transient failures with exponential backoff and full jitter, within
+    a retry budget shared by the whole run
+    """
+
+    RETRYABLE_GOOGLE_ERRORS = (
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+    )
+    RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+    # the server did not apply the request, so even a POST may be retried
+    UNAPPLIED_STATUS_CODES = (429, 503)
+
+    def __init__(self, attempts, budget):
+        self.attempts = attempts
+        self.budget = budget
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def is_retryable(self, exc, idempotent=True):
+        """Is this error worth retrying?  Requests which are not idempotent are
+        only retried if the server cannot have applied them, as a gateway error
+        may come after the request was applied
+        """
+        if isinstance(exc, self.RETRYABLE_GOOGLE_ERRORS):
+            return True
+        status_codes = (
+            self.RETRYABLE_STATUS_CODES if idempotent else self.UNAPPLIED_STATUS_CODES
+        )
+        return isinstance(exc, APIError) and exc.status_code in status_codes
+
+    def next_delay(self, exc, attempt, idempotent=True):
+        """Return how long to wait before retrying, or `None` to give up"""
+        if attempt + 1 >= self.attempts or not self.is_retryable(exc, idempotent):
+            return None
+        with self.lock:
+            if self.retries >= self.budget:
+                logger.warning("Retry budget exhausted, not retrying %s", exc)
+                return None
+            self.retries += 1
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+        logger.warning("Retrying in %.1f seconds after error: %s", delay, exc)
+        return delay
+
+    def call(self, func, *args, idempotent=True, **kwargs):
+        """Call func, retrying transient failures.  Pass `idempotent=False` for
+        requests, such as POSTs, which must not be applied twice
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                delay = self.next_delay(exc, attempt, idempotent)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, func, *args, **kwargs):
+        """Await the coroutine function func, retrying transient failures"""
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as exc:  # pylint: disable=broad-except
+                delay = self.next_delay(exc, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class SQLiteCache:
+    """A key value cache stored in a table of a local SQLite database, which may
+    be shared between worker threads
+    """
+
+    def __init__(self, path, table, namespace="", max_entries=None):
+        self.table = table
+        # prefixed to every key, to keep caches for different servers apart
+        self.namespace = namespace
+        # if set, the least recently used entries are evicted past this size
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value, accessed REAL NOT NULL)"
+            )
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys which are present in the cache"""
+        found = {}
+        for group in grouper(keys, SQLITE_VARIABLE_LIMIT):
+            group = [f"{self.namespace}{g}" for g in group if g is not None]
+            placeholders = ",".join("?" * len(group))
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM {self.table} "
+                    f"WHERE key IN ({placeholders})",
+                    group,
+                ).fetchall()
+            if self.max_entries is not None and rows:
+                self._touch([key for key, _ in rows])
+            for key, value in rows:
+                found[key[len(self.namespace) :]] = value
+        return found
+
+    def _touch(self, keys):
+        """Mark the keys as recently used"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"UPDATE {self.table} SET accessed = ? WHERE key = ?",
+                [(now, key) for key in keys],
+            )
+
+    def set_many(self, items):
+        """Store all of the key value pairs from the dictionary"""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                [(f"{self.namespace}{k}", v, now) for k, v in items.items()],
+            )
+            if self.max_entries is not None:
+                self.conn.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY accessed DESC "
+                    "LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+
+class SharedWikiMapper(WikiMapper):
+    """A WikiMapper whose connection may be shared between worker threads"""
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, path_to_db):
+        self._path_to_db = path_to_db
+        # the index is only read, so open it read only and allow it to be used
+        # from threads other than the one which opened it
+        self.conn = sqlite3.connect(
+            f"file:{path_to_db}?mode=ro", uri=True, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+
+    def urls_to_ids(self, wiki_urls):
+        """Map many Wikipedia URLs to their Wikidata IDs using a few set based
+        queries.  Returns a dictionary containing the URLs which could be mapped
+        """
+        titles = {}
+        for wiki_url in set(wiki_urls):
+            titles.setdefault(wiki_url.rsplit("/", 1)[-1], []).append(wiki_url)
+
+        mapping = {}
+        for group in grouper(titles, SQLITE_VARIABLE_LIMIT):
+            group = [g for g in group if g is not None]
+            placeholders = ",".join("?" * len(group))
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT wikipedia_title, wikidata_id FROM mapping "
+                    f"WHERE wikipedia_title IN ({placeholders})",
+                    group,
+                ).fetchall()
+            for title, wikidata_id in rows:
+                if wikidata_id is None:
+                    continue
+                for wiki_url in titles[title]:
+                    mapping.setdefault(wiki_url, wikidata_id)
+        return mapping
+
+
+class GCPEntityExtractor(SoftTimeOutAddOn):
     """Extract entities using GCP NLP API"""
 
+    soft_time_limit = SOFT_TIME_LIMIT
+
     def __init__(self):
         super().__init__()
         self.errors = 0
         self.successes = 0
+        # the messages of the documents which failed
+        self.failures = []
+        # guards the counters, which are updated from the worker threads
+        self.lock = threading.Lock()
+        self._language_client = None
+        self._language_client_lock = threading.Lock()
+        self._mapper = None
+        self._mapper_lock = threading.Lock()
+        self.wikidata_cache = LRUCache(WIKIDATA_CACHE_SIZE)
+        self._entity_cache = None
+        self._entity_cache_lock = threading.Lock()
+        self._nlp_cache = None
+        self._nlp_cache_lock = threading.Lock()
+        # documents with no pages changed since the last run
+        self.unchanged = 0
+        # set when the remaining documents are to be handed to a new run
+        self.continued = False
+        self.rate_limiter = RateLimiter(
+            self.data.get("requests_per_minute", REQUESTS_PER_MINUTE),
+            self.data.get("characters_per_minute", CHARACTERS_PER_MINUTE),
+        )
+        self.retry = RetryPolicy(
+            RETRY_ATTEMPTS, self.data.get("retry_budget", RETRY_BUDGET)
+        )
+        self.entity_batcher = AdaptiveBatcher()
+        self.occurrence_batcher = AdaptiveBatcher()
+        # set up on the event loop when running with the `asyncio` parameter
+        self.semaphore = None
+        self.async_language_client = None
 
     def setup_credential_file(self):
         """Sets up Google Cloud developer credential file"""
@@ -40,118 +1025,588 @@ class GCPEntityExtractor(AddOn):
             gac.write(credentials.encode("ascii"))
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = gac.name
 
+    def setup_session(self):
+        """Replace the API client's session with one which pools connections"""
+        session = PooledSession(POOL_SIZE)
+        session.headers.update(self.client.session.headers)
+        self.client.session = session
+
+    @property
+    def language_client(self):
+        """A single Natural Language API client, created on first use and shared
+        by every chunk of every document
+        """
+        with self._language_client_lock:
+            if self._language_client is None:
+                start = time.perf_counter()
+                self._language_client = language_v1.LanguageServiceClient()
+                # this is the set up cost which was previously paid for every chunk
+                logger.info(
+                    "Created language service client in %.3f seconds",
+                    time.perf_counter() - start,
+                )
+            return self._language_client
+
+    @property
+    def mapper(self):
+        """The Wikipedia to Wikidata mapper, opened once on first use and held for
+        the rest of the run
+        """
+        with self._mapper_lock:
+            if self._mapper is None:
+                self._mapper = SharedWikiMapper(WIKIMAPPER_DB)
+            return self._mapper
+
+    @property
+    def entity_cache(self):
+        """Cache of Wikidata ID to DocumentCloud entity ID, shared by the documents
+        of a run, see `CACHE_DB`
+        """
+        with self._entity_cache_lock:
+            if self._entity_cache is None:
+                # entity IDs are specific to the DocumentCloud instance
+                self._entity_cache = SQLiteCache(
+                    CACHE_DB, "entities", namespace=f"{self.client.base_uri}|"
+                )
+            return self._entity_cache
+
+    @property
+    def nlp_cache(self):
+        """Cache of entity extraction results keyed by content hash, which saves
+        paying for duplicated text within a run, see `CACHE_DB`.  Progress on a
+        document which must survive the run is kept in its checkpoint instead
+        """
+        with self._nlp_cache_lock:
+            if self._nlp_cache is None:
+                self._nlp_cache = SQLiteCache(
+                    CACHE_DB, "nlp_responses", max_entries=NLP_CACHE_ENTRIES
+                )
+            return self._nlp_cache
+
+    def get_page_hashes(self, document):
+        """The page hashes stored in the document's data, or `None` if there are
+        none
+        """
+        values = (document.data or {}).get(PAGE_HASH_KEY)
+        if not values:
+            return None
+        try:
+            return decode_page_hashes(values)
+        except ValueError:
+            logger.warning("Ignoring malformed page hashes for %s", document)
+            return None
+
+    def store_page_hashes(self, job):
+        """Store the document's page hashes in its data once its entities are up
+        to date, so the next run only extracts the pages which change
+        """
+        if job.changed_pages is not None and not job.changed_pages:
+            # the stored hashes are already up to date
+            return
+        try:
+            self.retry.call(
+                self.client.put,
+                f"documents/{job.document.id}/data/{PAGE_HASH_KEY}/",
+                json={"values": encode_page_hashes(job.page_hashes)},
+            )
+        except (APIError, requests.exceptions.RequestException) as exc:
+            # the entities are up to date, the next run will just extract every
+            # page again
+            logger.warning(
+                "Could not store the page hashes for %s: %s", job.document, exc
+            )
+
+    def urls_to_ids(self, wikipedia_urls):
+        """Map Wikipedia URLs to their Wikidata IDs, or `None` if they have none.
+        Cached URLs are served from memory and the rest are resolved in bulk
+        """
+        wikidata_ids = {}
+        missing = []
+        for wikipedia_url in set(wikipedia_urls):
+            wikidata_id = self.wikidata_cache.get(wikipedia_url)
+            if wikidata_id is LRUCache.MISSING:
+                missing.append(wikipedia_url)
+            else:
+                wikidata_ids[wikipedia_url] = wikidata_id
+
+        if missing:
+            logger.info("Resolving %d Wikipedia URLs", len(missing))
+            resolved = self.mapper.urls_to_ids(missing)
+            for wikipedia_url in missing:
+                wikidata_id = resolved.get(wikipedia_url)
+                self.wikidata_cache.set(wikipedia_url, wikidata_id)
+                wikidata_ids[wikipedia_url] = wikidata_id
+        return wikidata_ids
+
     def main(self):
         """Set up the credential file and extract entities for each document"""
         self.setup_credential_file()
-        for document in self.get_documents():
-            self.extract_entities(document)
+        self.setup_session()
+        if self.data.get("asyncio"):
+            asyncio.run(self.main_async())
+        else:
+            self.main_threaded()
+        if self.continued:
+            super().rerun_addon()
+        logger.info(
+            "Wikidata cache: %d hits, %d misses, %d retries",
+            self.wikidata_cache.hits,
+            self.wikidata_cache.misses,
+            self.retry.retries,
+        )
+        message = (
+            f"Extracted entities for {self.successes} documents "
+            f"with {self.errors} errors "
+            f"(Wikidata cache: {self.wikidata_cache.hits} hits, "
+            f"{self.wikidata_cache.misses} misses)."
+        )
+        if self.unchanged:
+            message += (
+                f" {self.unchanged} documents had not changed since the last run."
+            )
+        if self.failures:
+            message += " " + " ".join(self.failures[:REPORTED_FAILURES])
+        if len(self.failures) > REPORTED_FAILURES:
+            message += (
+                f" {len(self.failures) - REPORTED_FAILURES} more documents failed,"
+                " see the logs for details."
+            )
+        if self.continued:
+            message += " Continuing with the remaining documents in a new run."
+        self.set_message(message)
+
+    def rerun_addon(self, include_current=False):
+        """Hand the remaining documents to a new run once the documents already
+        in flight are finished, rather than straight away, so that the two runs
+        do not compete for the API quota
+        """
+        self.continued = True
+
+    def main_threaded(self):
+        """Extract entities for the documents with a pipeline of worker threads,
+        so that different documents can be in different stages at once
+        """
+        workers = self.data.get("max_workers", MAX_WORKERS)
+        pipeline = Pipeline(
+            [
+                # streams the text and analyzes the chunks as they are planned
+                ("extract", self.extract_entities, workers),
+                # the Wikidata index is behind a lock, so one worker is enough
+                ("resolve", self.resolve_entities, 1),
+                ("create", self.create_entities, workers),
+                ("post", self.create_entity_occurrences, workers),
+            ],
+            QUEUE_SIZE,
+            on_success=self.document_succeeded,
+            on_error=self.document_failed,
+        )
+        pipeline.run(DocumentJob(document) for document in self.get_documents())
+
+    def document_succeeded(self, job):
+        """Count a document which made it through every stage"""
+        with self.lock:
+            self.successes += 1
+
+    def document_failed(self, job, exc):
+        """Record a failure for one document, without stopping the others"""
+        if isinstance(exc, DocumentError):
+            logger.error(
+                "Error extracting entities for document %s: %s", job.document.id, exc
+            )
+            failure = str(exc)
+        else:
+            logger.error(
+                "Error extracting entities for document %s",
+                job.document.id,
+                exc_info=exc,
+            )
+            failure = f"The document {job.document.id} failed with an unexpected error."
+        with self.lock:
+            self.errors += 1
+            self.failures.append(failure)
+
+    def get_all_pages(self, url, params=None):
+        """Yield the results from every page of a list endpoint, fetching the
+        next page in the background while the current one is being processed
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            resp = self.retry.call(self.client.get, url, params=params)
+            while True:
+                resp_json = resp.json()
+                next_page = None
+                if resp_json.get("next"):
+                    next_page = executor.submit(
+                        self.retry.call,
+                        self.client.get,
+                        resp_json["next"],
+                        full_url=True,
+                    )
+                yield from resp_json["results"]
+                if next_page is None:
+                    return
+                resp = next_page.result()
+
+    def get_entity_map(self, wikidata_ids):
+        """Map Wikidata IDs to the IDs of the entities which already exist on
+        DocumentCloud, looking them up in concurrent batches
+        """
+
+        def lookup(group):
+            params = {
+                "wikidata_id__in": ",".join(q for q in group if q is not None),
+                "per_page": PER_PAGE,
+            }
+            return [
+                (entity["wikidata_id"], entity["id"])
+                for entity in self.get_all_pages("entities/", params=params)
+            ]
+
+        entity_map = {}
+        with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+            for pairs in executor.map(lookup, grouper(wikidata_ids, LOOKUP_LIMIT)):
+                entity_map.update(pairs)
+        return entity_map
+
+    def get_existing_occurrences(self, document):
+        """Fetch the occurrences of each entity already on the document.  Errors
+        are raised, as the changes are built from these
+        """
+        return {
+            entity["entity"]: entity["occurrences"]
+            for entity in self.get_all_pages(
+                f"documents/{document.id}/entities/", params={"per_page": PER_PAGE}
+            )
+        }
 
     def get_existing_entities(self, document):
         """Fetch existing entities for the document"""
         try:
-            resp = self.client.get(f"documents/{document.id}/entities/")
-            return {entity["entity"] for entity in resp.json()["results"]}
+            return {
+                entity["entity"]
+                for entity in self.get_all_pages(
+                    f"documents/{document.id}/entities/", params={"per_page": PER_PAGE}
+                )
+            }
         except APIError as api_error:
             logger.error("API Error while fetching existing entities: %s", api_error)
             return set()
 
-    def extract_entities(self, document):
+    def extract_entities(self, job):
         """Coordinate the extraction of all of the entities"""
+        document = job.document
         try:
-            all_page_text = document.get_json_text()
+            pages = self.open_pages(document)
         except DoesNotExistError:
-            self.set_message(
-                f"The document {document.id}" 
-                "has not been OCR'd recently and is missing a JSON txt file."
-                "Apply OCR and try this Add-On again"
-            )
-            sys.exit(0)
-        texts = []
-        total_bytes = 0
-        page_map = [0]
-        character_offset = 0
-        total_characters = 0
-        entities = []
+            self.missing_text(document)
+        self.start_extraction(job)
 
+        chunk_workers = self.data.get("chunk_workers", CHUNK_WORKERS)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=chunk_workers) as executor:
+            # chunks are sent as soon as they are planned, with a bounded number
+            # waiting so only a few are held in memory.  Results are collected
+            # in chunk order, so mentions stay in offset order
+            for chunk in log_plan(
+                document, chunk_pages(pages, job.page_map, job.page_changed)
+            ):
+                pending.append(executor.submit(self.extract_entities_text, job, *chunk))
+                if len(pending) > chunk_workers:
+                    job.entities.extend(pending.popleft().result())
+            for future in pending:
+                job.entities.extend(future.result())
+        self.finish_extraction(job)
+
+    def start_extraction(self, job):
+        """Load the page hashes from the document's last run, so only the pages
+        which have changed since then are extracted, and the checkpoint of any
+        run which stopped part way through it
+        """
+        if self.data.get("full_extraction"):
+            # every page counts as changed, so the entities already on the
+            # document are all replaced
+            job.set_previous_hashes([])
+        else:
+            previous_hashes = self.get_page_hashes(job.document)
+            if previous_hashes is not None:
+                job.set_previous_hashes(previous_hashes)
+        values = (job.document.data or {}).get(CHECKPOINT_KEY)
+        if values:
+            job.checkpoint = decode_checkpoint(values, time.time())
+            job.checkpointed = True
+            logger.info(
+                "Resuming %s with %d chunks already extracted",
+                job.document,
+                len(job.checkpoint),
+            )
         logger.info(
             "Extracting entities for %s, %d pages",
-            document,
-            len(all_page_text["pages"]),
+            job.document,
+            job.document.page_count,
         )
 
-        for page in all_page_text["pages"]:
-            # page map is stored in unicode characters
-            # we add the current page's length in characters to the beginning of the
-            # last page, to get the start character of the next page
-            page_chars = len(page["contents"]) + 2
-            page_map.append(page_map[-1] + page_chars)
-            # the API limit is based on byte size, so we use the length of the
-            # content encoded into utf8
-            page_bytes = len(page["contents"].encode("utf8"))
-            if page_bytes > BYTE_LIMIT:
-                logger.error("Single page too long for entity extraction")
-                return
+    def finish_extraction(self, job):
+        """Work out which pages have changed, once all of them have been read"""
+        job.pages_read()
+        if job.changed_pages is not None:
+            logger.info(
+                "%d pages of %s have changed since the last run",
+                len(job.changed_pages),
+                job.document,
+            )
+
+    def resolve_entities(self, job):
+        """Map the document's entities to Wikidata IDs"""
+        self.resolve_wikidata_ids(job.entities)
 
-            if total_bytes + page_bytes > BYTE_LIMIT:
-                # if adding another page would put us over the limit,
-                # send the current chunk of text to be analyzed
-                logger.info("Extracting to page %d", page["page"])
-                entities.extend(
-                    self.extract_entities_text("".join(texts), character_offset)
+    def create_entities(self, job):
+        """Get or create the document's entities on DocumentCloud and build the
+        occurrences to post for them
+        """
+        if job.changed_pages is not None:
+            self.replace_changed_pages(job)
+            return
+        job.existing_entities = self.get_existing_entities(job.document)
+        logger.info("Creating %d entities", len(job.entities))
+        job.entity_map = self.get_or_create_entities(job.entities)
+        job.occurrences = self.build_occurrences(
+            job.entities, job.entity_map, job.existing_entities, job.page_map
+        )
+
+    def replace_changed_pages(self, job):
+        """Build the changes to the document's entity occurrences when only the
+        changed pages were extracted.  Occurrences on the changed pages are
+        replaced, and the rest are kept with their offsets updated for any
+        change in the length of the pages before them
+        """
+        if not job.changed_pages:
+            logger.info("No pages of %s have changed, skipping", job.document)
+            with self.lock:
+                self.unchanged += 1
+            return
+        existing = self.get_existing_occurrences(job.document)
+        job.existing_entities = set(existing)
+        logger.info("Creating %d entities", len(job.entities))
+        job.entity_map = self.get_or_create_entities(job.entities)
+        occurrences = self.build_occurrences(
+            job.entities, job.entity_map, set(), job.page_map
+        )
+        job.occurrences = [o for o in occurrences if o["entity"] not in existing]
+        found = {
+            o["entity"]: o["occurrences"]
+            for o in occurrences
+            if o["entity"] in existing
+        }
+        for entity_id, old_occurrences in existing.items():
+            kept = [
+                dict(
+                    occurrence,
+                    offset=job.page_map[occurrence["page"]] + occurrence["page_offset"],
                 )
-                character_offset = total_characters
-                texts = [page["contents"] + "\n\n"]
-                total_bytes = page_bytes
-                total_characters += page_chars
-            else:
-                # otherwise append the current page and accumulate the length
-                texts.append(page["contents"] + "\n\n")
-                total_bytes += page_bytes
-                total_characters += page_chars
+                for occurrence in old_occurrences
+                if occurrence["page"] not in job.changed_pages
+            ]
+            if entity_id in found:
+                job.updates[entity_id] = sorted(
+                    kept + found[entity_id], key=lambda o: o["offset"]
+                )
+            elif kept != old_occurrences:
+                job.updates[entity_id] = kept
+        logger.info(
+            "Posting %d new entities and updating %d for %s",
+            len(job.occurrences),
+            len(job.updates),
+            job.document,
+        )
 
-        # analyze the remaining text
-        logger.info("Extracting to end")
-        entities.extend(self.extract_entities_text("".join(texts), character_offset))
+    def open_pages(self, document):
+        """Start downloading the document's JSON text, returning an iterator
+        over its pages which parses them as they arrive.  Without ijson the
+        whole text is loaded first
+        """
+        if ijson is None:
+            return iter(document.get_json_text()["pages"])
+        url = document.json_text_url
+        if urlparse(url).netloc == urlparse(self.client.base_uri).netloc:
+            # private assets are served by the API and need our credentials.  The
+            # client's own get reads the whole body to log it, so it cannot be
+            # used to stream, and the session is used directly
+            response = self.client.session.get(
+                url, stream=True, timeout=self.client.timeout
+            )
+            if response.status_code == 403:
+                # the access token may have expired, so refresh it and try once
+                # more, as the client does
+                response.close()
+                self.client._set_tokens()  # pylint: disable=protected-access
+                response = self.client.session.get(
+                    url, stream=True, timeout=self.client.timeout
+                )
+            if response.status_code >= 400:
+                response.close()
+            self.client.raise_for_status(response)
+        else:
+            response = requests_retry_session().get(url, stream=True, timeout=60)
+            if response.status_code in (403, 404):
+                response.close()
+                raise DoesNotExistError(response=response)
+            response.raise_for_status()
+        return stream_pages(response)
 
-        self.create_entity_occurrences(entities, document, page_map)
+    def missing_text(self, document):
+        """Fail a document which has no JSON text"""
+        raise DocumentError(
+            f"The document {document.id} "
+            "has not been OCR'd recently and is missing a JSON txt file. "
+            "Apply OCR and try this Add-On again."
+        )
 
-    def extract_entities_text(self, text, character_offset):
+    def extract_entities_text(self, job, text, runs):
         """Extract the entities from a given chunk of text from the document"""
-        client = language_v1.LanguageServiceClient()
+        key = self.nlp_cache_key(text)
+        entities = self.get_checkpointed_entities(job, key)
+        if entities is None:
+            entities = self.get_cached_entities(text)
+        if entities is None:
+            entities = self.analyze_text(text)
+            self.cache_entities(text, entities)
+            self.save_checkpoint(job, key, entities)
+        return offset_entities(entities, runs)
+
+    def get_checkpointed_entities(self, job, key):
+        """Return the entities an earlier run extracted from this chunk of the
+        document, or `None` if it did not
+        """
+        if key not in job.checkpoint:
+            return None
+        logger.info("Using checkpointed entity extraction results")
+        return [Entity.from_json(e) for e in job.checkpoint[key]]
+
+    def save_checkpoint(self, job, key, entities):
+        """Add the entities extracted from a chunk to the document's checkpoint,
+        so they are not paid for again if the run stops before the document is
+        finished
+        """
+        try:
+            self.retry.call(
+                self.client.patch,
+                f"documents/{job.document.id}/data/{CHECKPOINT_KEY}/",
+                json={"values": encode_checkpoint(key, entities, time.time())},
+            )
+        except (APIError, requests.exceptions.RequestException) as exc:
+            # only the progress is lost
+            logger.warning("Could not checkpoint a chunk of %s: %s", job.document, exc)
+            return
+        job.checkpointed = True
+
+    def clear_checkpoint(self, job):
+        """Remove the document's checkpoint once it is finished"""
+        if not job.checkpointed:
+            return
+        try:
+            self.retry.call(
+                self.client.delete,
+                f"documents/{job.document.id}/data/{CHECKPOINT_KEY}/",
+            )
+        except (APIError, requests.exceptions.RequestException) as exc:
+            # the checkpoint expires, and only matches chunks which are unchanged
+            logger.warning(
+                "Could not remove the checkpoint for %s: %s", job.document, exc
+            )
+
+    def nlp_cache_key(self, text):
+        """Key the entity extraction cache on everything which affects the
+        response, not just the text
+        """
+        return hashlib.sha256(
+            f"{NLP_CACHE_VERSION}|PLAIN_TEXT|UTF32|{text}".encode("utf8")
+        ).hexdigest()
+
+    def get_cached_entities(self, text):
+        """Return the cached entities for this text, or `None` if not cached"""
+        key = self.nlp_cache_key(text)
+        cached = self.nlp_cache.get_many([key])
+        if key not in cached:
+            return None
+        logger.info("Using cached entity extraction results")
+        return [Entity.from_json(e) for e in json.loads(zlib.decompress(cached[key]))]
+
+    def cache_entities(self, text, entities):
+        """Store the entities extracted from this text in the cache"""
+        self.nlp_cache.set_many(
+            {
+                self.nlp_cache_key(text): zlib.compress(
+                    json.dumps([e.to_json() for e in entities]).encode("utf8")
+                )
+            }
+        )
+
+    def analyze_text(self, text):
+        """Call the entity extraction API on a chunk of text"""
         language_document = language_v1.Document(
             content=text, type_=language_v1.Document.Type.PLAIN_TEXT
         )
-        logger.info("Calling entity extraction API")
-        response = client.analyze_entities(
-            document=language_document, encoding_type="UTF32"
-        )
-        logger.info("Converting response to dictionary representatpution")
-        entities = AnalyzeEntitiesResponse.to_dict(response)["entities"]
 
-        # only get entities with Wikipedia URLs for now
-        entities = [e for e in entities if "wikipedia_url" in e["metadata"]]
+        def analyze():
+            self.rate_limiter.wait(len(text))
+            logger.info("Calling entity extraction API")
+            return self.language_client.analyze_entities(
+                document=language_document, encoding_type="UTF32"
+            )
 
-        # adjust for character offset
-        for entity in entities:
-            for mention in entity["mentions"]:
-                mention["text"]["begin_offset"] += character_offset
-        return entities
+        return entities_from_response(self.retry.call(analyze))
 
-    def create_entity_occurrences(self, entities, document, page_map):
+    def create_entity_occurrences(self, job):
         """Create the entity occurrence objects in the database,
         linking the entities to the document
         """
-        existing_entities = self.get_existing_entities(document)
-        logger.info("Creating %d entities", len(entities))
-        entity_map = self.get_or_create_entities(entities)
+        post_workers = self.data.get("post_workers", POST_WORKERS)
+        pending = deque()
+        errors = []
+        with ThreadPoolExecutor(max_workers=post_workers) as executor:
+            # batches are made as workers become free, so that they are sized
+            # by how the server has been responding
+            for func, *args in self.occurrence_requests(job):
+                pending.append(executor.submit(func, *args))
+                if len(pending) >= post_workers:
+                    errors.append(pending.popleft().result())
+            errors.extend(future.result() for future in pending)
+        self.finish_occurrences(job, errors)
+
+    def occurrence_requests(self, job):
+        """Yield the function and arguments for each request needed to bring the
+        document's entity occurrences up to date
+        """
+        return chain(
+            (
+                (self.post_occurrences, job, batch)
+                for batch in self.occurrence_batcher.batches(job.occurrences)
+            ),
+            (
+                (self.update_occurrences, job, entity_id, occurrences)
+                for entity_id, occurrences in job.updates.items()
+            ),
+        )
+
+    def finish_occurrences(self, job, errors):
+        """Report any errors from the occurrence requests, failing the document,
+        or store its page hashes and remove its checkpoint if they all succeeded
+        """
+        self.report_post_errors(job.document, errors)
+        self.store_page_hashes(job)
+        self.clear_checkpoint(job)
+
+    def build_occurrences(self, entities, entity_map, existing_entities, page_map):
+        """Collapse the entities by DocumentCloud entity and build the JSON for
+        the entity occurrences which do not exist yet
+        """
         # remove entities which still do not have a wikidata_id
-        entities = [e for e in entities if e["metadata"]["wikidata_id"] is not None]
+        entities = [e for e in entities if e.wikidata_id is not None]
 
         logger.info("Collapse entity occurrences")
         collapsed_entities = {}
         for entity in entities:
             try:
-                entity_id = entity_map[entity["metadata"]["wikidata_id"]]
+                entity_id = entity_map[entity.wikidata_id]
             except KeyError as k:
                 print(f"Key Error: {k}")
                 continue
@@ -160,107 +1615,369 @@ class GCPEntityExtractor(AddOn):
                 continue
 
             if entity_id in collapsed_entities:
-                collapsed_entities[entity_id]["mentions"].extend(entity["mentions"])
+                collapsed_entities[entity_id].mentions.extend(entity.mentions)
             else:
                 collapsed_entities[entity_id] = entity
 
         logger.info("Create entity occurrence objects")
-        occurrence_json = []
-        occurrence_json = [
+        # locate every mention in the document in one pass, in the same order
+        # they are consumed below
+        locations = iter(
+            locate_offsets(
+                [
+                    mention.offset
+                    for entity in collapsed_entities.values()
+                    for mention in entity.mentions
+                ],
+                page_map,
+            )
+        )
+        return [
             {
                 "entity": entity_id,
-                "relevance": entity["salience"],
-                "occurrences": self.transform_mentions(entity["mentions"], page_map),
+                "relevance": entity.salience,
+                "occurrences": self.transform_mentions(entity.mentions, locations),
             }
             for entity_id, entity in collapsed_entities.items()
-            if entity_id not in existing_entities
         ]
 
-        for group in grouper(occurrence_json, BULK_LIMIT):
+    def post_occurrences(self, job, occurrences):
+        """Post one batch of entity occurrences for the document, returning the
+        error if it failed
+        """
+        url = f"documents/{job.document.id}/entities/"
+        try:
+            self.post_batch(self.occurrence_batcher, url, occurrences)
+        except requests.exceptions.Timeout as timeout:
+            # the server may have applied the batch, so check which entities
+            # are on the document before posting the rest again
             try:
-                self.client.post(
-                    f"documents/{document.id}/entities/",
-                    json=[g for g in group if g is not None],
+                existing = self.get_existing_occurrences(job.document)
+            except (APIError, requests.exceptions.RequestException):
+                return timeout
+            missing = [o for o in occurrences if o["entity"] not in existing]
+            if not missing:
+                return None
+            logger.info(
+                "Posting %d of %d entities again after a timeout",
+                len(missing),
+                len(occurrences),
+            )
+            try:
+                self.post_batch(self.occurrence_batcher, url, missing)
+            except (APIError, requests.exceptions.Timeout) as exc:
+                return exc
+        except APIError as api_error:
+            return api_error
+        return None
+
+    def update_occurrences(self, job, entity_id, occurrences):
+        """Replace the occurrences of an entity already on the document, or
+        remove it if it has none left, returning the error if it failed
+        """
+        url = f"documents/{job.document.id}/entities/{entity_id}/"
+        try:
+            if occurrences:
+                self.retry.call(
+                    self.client.patch, url, json={"occurrences": occurrences}
                 )
-            except APIError as api_error:
-                logger.error("API Error: %s", api_error)
-                error_code = api_error.status_code
-                if error_code == 400:
-                    self.set_message(
-                        "Indexing error. Please try applying OCR to the document"
-                        f"{document.id} and running this Add-On again."
-                    )
-                    logger.error(
-                        "There is an indexing issue with posting entities to this document"
-                    )
-                    sys.exit(0)
-                if error_code == 403:
-                    logger.error(
-                        "You do not have permission to create entities on document %s",
-                        document.id,
-                    )
-                self.errors += 1
+            else:
+                self.retry.call(self.client.delete, url)
+        except APIError as api_error:
+            return api_error
+        return None
 
-    def get_or_create_entities(self, entities):
-        """Get or create the entities returned from the API in the database"""
+    def post_batch(self, batcher, url, batch):
+        """Post a batch to a bulk endpoint, feeding back how it went to the
+        batcher.  Batches which are too large are split in half and tried again.
+        Other errors are raised, including timeouts, after which the server may
+        have applied the batch.  Returns the responses
+        """
+        start = None
 
-        mapper = WikiMapper("data/index_enwiki-latest.db")
-        for entity in entities:
-            logger.info("Mapping entity for %s", entity["metadata"]["wikipedia_url"])
-            entity["metadata"]["wikidata_id"] = mapper.url_to_id(
-                entity["metadata"]["wikipedia_url"]
+        def post():
+            nonlocal start
+            # only the final attempt is timed, not the backoff before it
+            start = time.monotonic()
+            return self.client.post(url, json=batch)
+
+        try:
+            resp = self.retry.call(post, idempotent=False)
+        except (APIError, requests.exceptions.Timeout) as exc:
+            too_large = getattr(exc, "status_code", None) == 413
+            batcher.record(time.monotonic() - start, too_large=too_large)
+            if not too_large or len(batch) == 1:
+                raise
+            logger.info("Splitting a batch of %d which was too large", len(batch))
+            half = len(batch) // 2
+            return self.post_batch(batcher, url, batch[:half]) + self.post_batch(
+                batcher, url, batch[half:]
+            )
+        batcher.record(time.monotonic() - start)
+        return [resp]
+
+    def report_post_errors(self, document, errors):
+        """Report the errors from posting a document's occurrence batches, in
+        batch order once they have all finished, failing the document if there
+        were any
+        """
+        failed = [api_error for api_error in errors if api_error is not None]
+        for i, api_error in enumerate(errors):
+            if api_error is None:
+                continue
+            logger.error(
+                "API Error in batch %d of %d: %s", i + 1, len(errors), api_error
+            )
+        if not failed:
+            return
+        error_codes = {getattr(api_error, "status_code", None) for api_error in failed}
+        if 400 in error_codes:
+            logger.error(
+                "There is an indexing issue with posting entities to this document"
             )
+            raise DocumentError(
+                "Indexing error. Please try applying OCR to the document "
+                f"{document.id} and running this Add-On again."
+            )
+        if 403 in error_codes:
+            logger.error(
+                "You do not have permission to create entities on document %s",
+                document.id,
+            )
+            raise DocumentError(
+                "You do not have permission to create entities on the document "
+                f"{document.id}."
+            )
+        raise DocumentError(
+            f"{len(failed)} of {len(errors)} requests to create entities on the "
+            f"document {document.id} failed."
+        )
+
+    # asyncio execution mode
+
+    async def main_async(self):
+        """Extract entities for the documents on an event loop, with a single
+        limit on the number of requests in flight shared by all documents.  A
+        fixed number of workers take documents one at a time, so only that many
+        documents have their text open at once
+        """
+        max_concurrency = self.data.get("max_concurrency", MAX_CONCURRENCY)
+        # blocking calls run in the default executor, which must have a thread
+        # for each request allowed in flight
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=max_concurrency)
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # the async client is bound to the running event loop
+        self.async_language_client = language_v1.LanguageServiceAsyncClient()
+        jobs = (DocumentJob(document) for document in self.get_documents())
+        # the generator may only be advanced by one thread at a time
+        jobs_lock = asyncio.Lock()
+
+        async def work():
+            while True:
+                async with jobs_lock:
+                    # fetching the next page of documents blocks
+                    job = await asyncio.to_thread(next, jobs, None)
+                if job is None:
+                    return
+                await self.process_document_async(job)
+
+        await asyncio.gather(
+            *(work() for _ in range(self.data.get("max_workers", MAX_WORKERS)))
+        )
+
+    async def run_io(self, func, *args, **kwargs):
+        """Run a blocking DocumentCloud call in a thread, under the shared limit.
+        The python-documentcloud client handles authentication and token refresh
+        and its session pools connections, so it is reused rather than replaced
+        """
+        async with self.semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def process_document_async(self, job):
+        """Extract entities for a single document, isolating any failure from
+        the rest of the run
+        """
+        try:
+            await self.extract_entities_async(job)
+            self.document_succeeded(job)
+        except Exception as exc:  # pylint: disable=broad-except
+            try:
+                self.document_failed(job, exc)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error while handling a failed job")
+
+    async def extract_entities_async(self, job):
+        """Extract the entities for a document, analyzing its chunks concurrently
+        as they are planned
+        """
+        document = job.document
+        try:
+            pages = await self.run_io(self.open_pages, document)
+        except DoesNotExistError:
+            self.missing_text(document)
+        await asyncio.to_thread(self.start_extraction, job)
 
-        # limit these to a certain number at a time
-        wikidata_ids = [
-            e["metadata"]["wikidata_id"]
-            for e in entities
-            if e["metadata"]["wikidata_id"] is not None
+        chunk_workers = self.data.get("chunk_workers", CHUNK_WORKERS)
+        # chunks are analyzed as soon as they are planned, with a bounded number
+        # waiting so only a few are held in memory, and the download overlaps
+        # the analysis
+        chunks = asyncio.Queue(maxsize=chunk_workers)
+        plan = enumerate(
+            log_plan(document, chunk_pages(pages, job.page_map, job.page_changed))
+        )
+        results = {}
+
+        async def produce():
+            while True:
+                # reading the stream blocks, so each chunk is planned in a thread
+                chunk = await self.run_io(next, plan, None)
+                if chunk is None:
+                    break
+                await chunks.put(chunk)
+            for _ in range(chunk_workers):
+                await chunks.put(None)
+
+        async def consume():
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    return
+                index, (text, runs) = chunk
+                results[index] = await self.extract_entities_text_async(job, text, runs)
+
+        tasks = [
+            asyncio.ensure_future(produce()),
+            *(asyncio.ensure_future(consume()) for _ in range(chunk_workers)),
         ]
-        resp = self.client.get(
-            "entities/", params={"wikidata_id__in": ",".join(wikidata_ids)}
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # stop the other tasks, so none is left waiting on the queue
+            for task in tasks:
+                task.cancel()
+            raise
+        # results are put back in chunk order, so mentions stay in offset order
+        job.entities = [entity for i in sorted(results) for entity in results[i]]
+        self.finish_extraction(job)
+
+        await self.create_entity_occurrences_async(job)
+
+    async def extract_entities_text_async(self, job, text, runs):
+        """Extract the entities from a given chunk of text from the document"""
+        key = self.nlp_cache_key(text)
+        entities = self.get_checkpointed_entities(job, key)
+        if entities is None:
+            entities = self.get_cached_entities(text)
+        if entities is None:
+            language_document = language_v1.Document(
+                content=text, type_=language_v1.Document.Type.PLAIN_TEXT
+            )
+
+            async def analyze():
+                await self.rate_limiter.wait_async(len(text))
+                logger.info("Calling entity extraction API")
+                async with self.semaphore:
+                    return await self.async_language_client.analyze_entities(
+                        document=language_document, encoding_type="UTF32"
+                    )
+
+            entities = entities_from_response(await self.retry.call_async(analyze))
+            self.cache_entities(text, entities)
+            await self.run_io(self.save_checkpoint, job, key, entities)
+        return offset_entities(entities, runs)
+
+    async def create_entity_occurrences_async(self, job):
+        """Create the entity occurrence objects in the database, posting all of
+        the batches concurrently
+        """
+        await asyncio.to_thread(self.resolve_entities, job)
+        if job.changed_pages is not None:
+            await self.run_io(self.replace_changed_pages, job)
+        else:
+            logger.info("Creating %d entities", len(job.entities))
+            job.existing_entities, job.entity_map = await asyncio.gather(
+                self.run_io(self.get_existing_entities, job.document),
+                self.run_io(self.get_or_create_entities, job.entities),
+            )
+            job.occurrences = self.build_occurrences(
+                job.entities, job.entity_map, job.existing_entities, job.page_map
+            )
+        errors = await asyncio.gather(
+            *(self.run_io(func, *args) for func, *args in self.occurrence_requests(job))
         )
+        # storing the page hashes may back off between retries, which must not
+        # hold up the event loop
+        await self.run_io(self.finish_occurrences, job, errors)
+
+    def resolve_wikidata_ids(self, entities):
+        """Set the Wikidata ID of each entity from its Wikipedia URL"""
+        wikidata_map = self.urls_to_ids(entity.wikipedia_url for entity in entities)
+        for entity in entities:
+            entity.wikidata_id = wikidata_map[entity.wikipedia_url]
+
+    def get_or_create_entities(self, entities):
+        """Get or create the entities returned from the API in the database"""
 
+        wikidata_ids = list(
+            dict.fromkeys(e.wikidata_id for e in entities if e.wikidata_id is not None)
+        )
         # map from Wikidata ID -> DocumentCloud entity ID
-        entity_map = {}
-        for entity in resp.json()["results"]:
-            entity_map[entity["wikidata_id"]] = entity["id"]
+        # entities learned earlier in the run are read from the local cache
+        cached = self.entity_cache.get_many(wikidata_ids)
+        logger.info(
+            "Found %d of %d entities in the local cache", len(cached), len(wikidata_ids)
+        )
+        entity_map = dict(cached)
+        entity_map.update(
+            self.get_entity_map([q for q in wikidata_ids if q not in cached])
+        )
 
         # if missing from the entity map, that means the entity does not exist
         # on DocumentCloud yet
         missing_wikidata_ids = [q for q in wikidata_ids if q not in entity_map]
-        for group in grouper(missing_wikidata_ids, BULK_LIMIT):
+        for batch in self.entity_batcher.batches(
+            [{"wikidata_id": q} for q in missing_wikidata_ids]
+        ):
             try:
-                resp = self.client.post(
-                    "entities/", json=[{"wikidata_id": q} for q in group if q is not None]
+                responses = self.post_batch(self.entity_batcher, "entities/", batch)
+            except requests.exceptions.Timeout:
+                # the server may have created them, so look them up rather than
+                # posting them again
+                entity_map.update(
+                    self.get_entity_map([item["wikidata_id"] for item in batch])
                 )
+                continue
             except APIError:
                 print("Duplicate entity")
                 break
             # TODO check resp status_code
-            for entity in resp.json():
-                try:
-                    entity_map[entity["wikidata_id"]] = entity["id"]
-                except KeyError as k:
-                    print(f"Key error:{k}")
-                    continue
+            for resp in responses:
+                for entity in resp.json():
+                    try:
+                        entity_map[entity["wikidata_id"]] = entity["id"]
+                    except KeyError as k:
+                        print(f"Key error:{k}")
+                        continue
+
+        self.entity_cache.set_many(
+            {q: id_ for q, id_ in entity_map.items() if q not in cached}
+        )
         return entity_map
 
-    def transform_mentions(self, mentions, page_map):
+    def transform_mentions(self, mentions, locations):
         """Format mentions how we want to store them in our database
-        Rename and flatten some fields and calculate page and page offset
+        Rename and flatten some fields and attach the page and page offset,
+        taken in order from the `locations` iterator
         """
         occurrences = []
-        for mention in mentions:
+        for mention, (page, page_offset) in zip(mentions, locations):
             occurrence = {}
-            occurrence["content"] = mention["text"]["content"]
+            occurrence["content"] = mention.content
             # occurrence["kind"] = mention["type_"]
 
-            offset = mention["text"]["begin_offset"]
-            page = bisect(page_map, offset) - 1
-            page_offset = offset - page_map[page]
-
-            occurrence["offset"] = offset
+            occurrence["offset"] = mention.offset
             occurrence["page"] = page
             occurrence["page_offset"] = page_offset
 
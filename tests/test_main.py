@@ -0,0 +1,535 @@
+"""Offline tests for the chunk planner, the checkpoints and the JSON text download"""
+
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from itertools import combinations
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import pytest
+import requests
+from documentcloud import DocumentCloud
+from documentcloud.exceptions import APIError
+from documentcloud.exceptions import DoesNotExistError
+
+import main
+
+
+def segments_of(lengths):
+    """ASCII segments of the given lengths, one byte per character"""
+    offsets = [0]
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    return [("x" * length, length, offset) for length, offset in zip(lengths, offsets)]
+
+
+def plan_cost(segments, chunks):
+    """The (requests, units) cost of a plan"""
+    return (
+        len(chunks),
+        sum(
+            main.billed_units(sum(len(t) for t, _, _ in segments[start:end]))
+            for start, end in chunks
+        ),
+    )
+
+
+def best_cost(segments, limit):
+    """The cheapest (requests, units) over every packing, by brute force"""
+    best = None
+    n = len(segments)
+    for cut_count in range(n):
+        for cuts in combinations(range(1, n), cut_count):
+            bounds = [0, *cuts, n]
+            chunks = list(zip(bounds, bounds[1:]))
+            if any(
+                sum(b for _, b, _ in segments[start:end]) > limit
+                for start, end in chunks
+            ):
+                continue
+            cost = plan_cost(segments, chunks)
+            if best is None or cost < best:
+                best = cost
+    return best
+
+
+def test_plan_chunks_is_optimal():
+    rng = random.Random(0)
+    for _ in range(300):
+        limit = rng.randint(1500, 4000)
+        segments = segments_of(
+            [rng.randint(1, 1500) for _ in range(rng.randint(1, 10))]
+        )
+        chunks = main.plan_chunks(segments, limit)
+        # the chunks cover every segment in order, and each fits in the limit
+        assert [start for start, _ in chunks] == [0] + [end for _, end in chunks][:-1]
+        assert chunks[-1][1] == len(segments)
+        assert all(
+            sum(b for _, b, _ in segments[start:end]) <= limit for start, end in chunks
+        )
+        assert plan_cost(segments, chunks) == best_cost(segments, limit)
+
+
+def test_chunk_pages_many_small_pages_is_fast():
+    pages = [{"page": i, "contents": "x" * 48} for i in range(60000)]
+    page_map = [0]
+    start = time.perf_counter()
+    chunks = list(main.chunk_pages(iter(pages), page_map))
+    assert time.perf_counter() - start < 5
+    assert "".join(text for text, _ in chunks) == "".join(
+        page["contents"] + "\n\n" for page in pages
+    )
+    assert len(chunks) == 3
+    assert len(page_map) == len(pages) + 1
+
+
+def test_page_hashes_round_trip_through_document_data():
+    page_hashes = [main.page_hash({"contents": f"page {i}"}) for i in range(2500)]
+    values = main.encode_page_hashes(page_hashes)
+    assert len(values) == 3
+    # the values are numbered, so their order in the data does not matter
+    assert main.decode_page_hashes(values[::-1]) == page_hashes
+    assert main.decode_page_hashes(main.encode_page_hashes([])) == []
+
+
+def test_checkpoint_round_trips_through_document_data():
+    rng = random.Random(0)
+    entities = [
+        main.Entity(
+            f"https://en.wikipedia.org/wiki/{i}",
+            rng.random(),
+            [main.Mention(f"W{i}", rng.randint(0, 10**6)) for _ in range(50)],
+        )
+        for i in range(200)
+    ]
+    now = time.time()
+    values = main.encode_checkpoint("a", entities, now)
+    # large checkpoints are split over several values
+    assert len(values) > 1
+    values += main.encode_checkpoint("b", [], now)
+    chunks = main.decode_checkpoint(values[::-1], now)
+    assert chunks["a"] == [entity.to_json() for entity in entities]
+    assert chunks["b"] == []
+
+    # chunks with a value missing, or which have expired, are left out
+    assert "a" not in main.decode_checkpoint(values[1:], now)
+    assert not main.decode_checkpoint(values, now + main.CHECKPOINT_EXPIRY + 1)
+
+
+def test_soft_time_out_waits_for_documents_in_flight():
+    posts = []
+    extractor = main.GCPEntityExtractor.__new__(main.GCPEntityExtractor)
+    extractor.__dict__.update(
+        documents=[1, 2, 3],
+        query=None,
+        data={},
+        id=7,
+        addon_id=8,
+        continued=False,
+        client=SimpleNamespace(
+            documents=SimpleNamespace(
+                list=lambda id__in: [SimpleNamespace(id=i) for i in id__in]
+            ),
+            post=lambda url, json: posts.append(json),
+            patch=lambda url, json: None,
+        ),
+        set_message=lambda message: None,
+    )
+    extractor._start = (  # pylint: disable=protected-access
+        time.time() - main.SOFT_TIME_LIMIT - 1
+    )
+    assert [d.id for d in extractor.get_documents()] == [1]
+    # the new run is only started once the document in flight is finished
+    assert extractor.continued
+    assert not posts
+    main.SoftTimeOutAddOn.rerun_addon(extractor)
+    assert posts[0]["documents"] == [2, 3]
+
+
+class BulkClient:
+    """Records the size of each bulk POST, failing the first with an error, and
+    lists the entities which the server applied
+    """
+
+    def __init__(self, error, applied):
+        self.error = error
+        # whether a POST which fails was applied anyway
+        self.applied = applied
+        self.posts = []
+        self.entities = []
+
+    def post(self, url, json):
+        self.posts.append(len(json))
+        if len(self.posts) == 1 and self.error is not None:
+            if self.applied:
+                self.entities.extend(json)
+            raise self.error
+        self.entities.extend(json)
+        return SimpleNamespace(json=lambda: [])
+
+    def get(self, url, params=None):
+        results = [{"entity": o["entity"], "occurrences": []} for o in self.entities]
+        return SimpleNamespace(json=lambda: {"results": results, "next": None})
+
+
+def bulk_extractor(client):
+    """An extractor which posts occurrences with client"""
+    extractor = main.GCPEntityExtractor.__new__(main.GCPEntityExtractor)
+    extractor.__dict__.update(
+        client=client,
+        retry=main.RetryPolicy(main.RETRY_ATTEMPTS, main.RETRY_BUDGET),
+        occurrence_batcher=main.AdaptiveBatcher(),
+        data={},
+        lock=threading.Lock(),
+        unchanged=0,
+    )
+    return extractor
+
+
+@pytest.mark.parametrize("applied, posts", [(True, [10]), (False, [10, 10])])
+def test_post_occurrences_checks_before_posting_again_after_a_timeout(applied, posts):
+    client = BulkClient(requests.exceptions.ReadTimeout(), applied)
+    job = main.DocumentJob(SimpleNamespace(id=1))
+    occurrences = [{"entity": i, "occurrences": []} for i in range(10)]
+    assert bulk_extractor(client).post_occurrences(job, occurrences) is None
+    assert client.posts == posts
+    assert sorted(o["entity"] for o in client.entities) == list(range(10))
+
+
+def test_post_occurrences_splits_batches_which_are_too_large():
+    client = BulkClient(
+        APIError(response=SimpleNamespace(status_code=413, text="")), False
+    )
+    job = main.DocumentJob(SimpleNamespace(id=1))
+    occurrences = [{"entity": i, "occurrences": []} for i in range(10)]
+    assert bulk_extractor(client).post_occurrences(job, occurrences) is None
+    assert client.posts == [10, 5, 5]
+
+
+def test_post_batch_times_only_the_final_attempt(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(
+        main.time,
+        "sleep",
+        lambda seconds: clock.__setitem__(0, clock[0] + seconds + 10),
+    )
+    attempts = []
+
+    def post(url, json):
+        attempts.append(json)
+        clock[0] += 0.5
+        if len(attempts) == 1:
+            raise APIError(response=SimpleNamespace(status_code=429, text=""))
+        return None
+
+    recorded = []
+    extractor = bulk_extractor(SimpleNamespace(post=post))
+    batcher = SimpleNamespace(
+        record=lambda seconds, too_large=False: recorded.append(seconds)
+    )
+    extractor.post_batch(batcher, "entities/", [{"wikidata_id": "Q1"}])
+    assert len(attempts) == 2
+    assert recorded == [0.5]
+
+
+class OccurrenceClient:
+    """Records the requests made to update a document's entity occurrences"""
+
+    def __init__(self):
+        self.requests = []
+
+    def post(self, url, json):
+        self.requests.append(("post", url, json))
+        return SimpleNamespace(json=lambda: [])
+
+    def patch(self, url, json):
+        self.requests.append(("patch", url, json))
+
+    def delete(self, url):
+        self.requests.append(("delete", url, None))
+
+    def put(self, url, json):
+        self.requests.append(("put", url, json))
+
+
+def occurrence(content, page, page_offset, page_map):
+    """An occurrence as stored on DocumentCloud"""
+    return {
+        "content": content,
+        "offset": page_map[page] + page_offset,
+        "page": page,
+        "page_offset": page_offset,
+    }
+
+
+def test_replace_changed_pages_updates_the_occurrences_on_the_document():
+    # the middle page grew from 30 to 50 characters
+    old_page_map = [0, 20, 50, 70]
+    page_map = [0, 20, 70, 90]
+    existing = {
+        # on an unchanged page before and after the changed page
+        100: [
+            occurrence("W1", 0, 3, old_page_map),
+            occurrence("W1", 2, 5, old_page_map),
+        ],
+        # only on the changed page, where it is no longer found
+        200: [occurrence("W2", 1, 5, old_page_map)],
+    }
+    entities = [
+        main.Entity("https://en.wikipedia.org/wiki/1", 0.5, [main.Mention("W1", 30)]),
+        main.Entity("https://en.wikipedia.org/wiki/3", 0.4, [main.Mention("W3", 40)]),
+    ]
+    entities[0].wikidata_id = "Q1"
+    entities[1].wikidata_id = "Q3"
+
+    client = OccurrenceClient()
+    extractor = bulk_extractor(client)
+    extractor.get_existing_occurrences = lambda document: existing
+    extractor.get_or_create_entities = lambda entities: {"Q1": 100, "Q3": 300}
+    job = main.DocumentJob(SimpleNamespace(id=1))
+    job.page_map = page_map
+    job.page_hashes = ["a", "b", "c"]
+    job.changed_pages = {1}
+    job.entities = entities
+    extractor.create_entities(job)
+    extractor.create_entity_occurrences(job)
+
+    assert sorted(client.requests, key=lambda r: r[:2]) == [
+        (
+            "delete",
+            "documents/1/entities/200/",
+            None,
+        ),
+        (
+            "patch",
+            "documents/1/entities/100/",
+            {
+                "occurrences": [
+                    occurrence("W1", 0, 3, page_map),
+                    occurrence("W1", 1, 10, page_map),
+                    # moved along by the change in the length of page 1
+                    occurrence("W1", 2, 5, page_map),
+                ]
+            },
+        ),
+        (
+            "post",
+            "documents/1/entities/",
+            [
+                {
+                    "entity": 300,
+                    "relevance": 0.4,
+                    "occurrences": [occurrence("W3", 1, 20, page_map)],
+                }
+            ],
+        ),
+        (
+            "put",
+            f"documents/1/data/{main.PAGE_HASH_KEY}/",
+            {"values": main.encode_page_hashes(["a", "b", "c"])},
+        ),
+    ]
+
+
+def test_unchanged_documents_are_left_alone():
+    client = OccurrenceClient()
+    extractor = bulk_extractor(client)
+    job = main.DocumentJob(SimpleNamespace(id=1))
+    job.page_hashes = ["a", "b"]
+    job.changed_pages = set()
+    extractor.create_entities(job)
+    extractor.create_entity_occurrences(job)
+    # not even the page hashes are stored again
+    assert not client.requests
+    assert extractor.unchanged == 1
+
+
+def test_full_extraction_ignores_the_stored_page_hashes():
+    extractor = bulk_extractor(OccurrenceClient())
+    page = {"contents": "page"}
+    document = SimpleNamespace(
+        id=1,
+        data={main.PAGE_HASH_KEY: main.encode_page_hashes([main.page_hash(page)])},
+        page_count=1,
+    )
+    for data, changed in (({}, False), ({"full_extraction": True}, True)):
+        extractor.data = data
+        job = main.DocumentJob(document)
+        extractor.start_extraction(job)
+        assert job.page_changed(0, page) is changed
+
+
+def test_pipeline_survives_failing_callbacks():
+    errors = []
+
+    def on_success(job):
+        if job % 2:
+            raise ConnectionError("lost the connection")
+
+    def on_error(job, exc):
+        errors.append(job)
+        if job == 3:
+            raise ConnectionError("lost the connection again")
+
+    pipeline = main.Pipeline(
+        [("first", lambda job: None, 1), ("second", lambda job: None, 1)],
+        1,
+        on_success=on_success,
+        on_error=on_error,
+    )
+    thread = threading.Thread(target=pipeline.run, args=(range(10),), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert errors == [1, 3, 5, 7, 9]
+
+
+def test_token_bucket_does_not_burst():
+    bucket = main.TokenBucket(600)
+    delays = [bucket.reserve(1) for _ in range(600)]
+    # the quota is spread over the first minute rather than granted at once
+    assert delays[0] > 0
+    assert delays[-1] >= 59
+
+    # after a pause only a couple of seconds of quota are saved up
+    bucket = main.TokenBucket(600)
+    bucket.updated -= 3600
+    delays = [bucket.reserve(1) for _ in range(100)]
+    assert delays.count(0) == 600 // 60 * main.RATE_LIMIT_BURST_SECONDS
+
+
+class TextHandler(BaseHTTPRequestHandler):
+    """Serves one document's JSON text to requests with the right token"""
+
+    token = "Bearer good"
+    text = json.dumps(
+        {"pages": [{"page": i, "contents": f"Page {i} " * 500} for i in range(20)]}
+    ).encode("utf8")
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.headers.get("Authorization") != self.token:
+            self.send_response(403)
+            self.end_headers()
+        elif self.path.startswith("/files/1.txt.json"):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.text)))
+            self.end_headers()
+            self.wfile.write(self.text)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture(name="extractor")
+def fixture_extractor():
+    """An extractor whose client points at a local server, as if the JSON text
+    of private documents were served from the API host
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TextHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # skip AddOn.__init__, which parses the command line
+    extractor = main.GCPEntityExtractor.__new__(main.GCPEntityExtractor)
+    extractor.client = DocumentCloud(
+        base_uri=f"http://127.0.0.1:{server.server_port}/api/"
+    )
+    extractor.client.session.headers["Authorization"] = "Bearer good"
+    extractor.setup_session()
+    yield extractor
+    server.shutdown()
+    server.server_close()
+
+
+def document(extractor, document_id):
+    """A document whose JSON text is served from the API host"""
+    host = urlparse(extractor.client.base_uri).netloc
+    return SimpleNamespace(
+        id=document_id, json_text_url=f"http://{host}/files/{document_id}.txt.json"
+    )
+
+
+def test_open_pages_streams_from_api_host(extractor, caplog):
+    # debug logging makes the client read response bodies, which must not
+    # affect the stream
+    caplog.set_level(logging.DEBUG)
+    pages = list(extractor.open_pages(document(extractor, 1)))
+    assert [page["page"] for page in pages] == list(range(20))
+    assert pages[3]["contents"] == "Page 3 " * 500
+
+
+def test_open_pages_refreshes_token_on_api_host(extractor, monkeypatch):
+    extractor.client.session.headers["Authorization"] = "Bearer expired"
+
+    def set_tokens():
+        extractor.client.session.headers["Authorization"] = "Bearer good"
+
+    monkeypatch.setattr(extractor.client, "_set_tokens", set_tokens)
+    pages = list(extractor.open_pages(document(extractor, 1)))
+    assert len(pages) == 20
+
+
+def test_open_pages_missing_on_api_host(extractor):
+    with pytest.raises(DoesNotExistError):
+        extractor.open_pages(document(extractor, 2))
+
+
+def async_extractor(analyze):
+    """An extractor for running a document through `extract_entities_async`,
+    with the analysis of each chunk done by analyze
+    """
+    extractor = main.GCPEntityExtractor.__new__(main.GCPEntityExtractor)
+    extractor.__dict__.update(
+        data={},
+        semaphore=asyncio.Semaphore(4),
+        extract_entities_text_async=analyze,
+    )
+
+    async def create_entity_occurrences_async(_job):
+        pass
+
+    extractor.create_entity_occurrences_async = create_entity_occurrences_async
+    return extractor
+
+
+def test_extract_entities_async_analyzes_chunks_as_they_are_planned():
+    pages_read = []
+    pages_read_at_analysis = []
+
+    def pages():
+        for i in range(60):
+            pages_read.append(i)
+            yield {"page": i, "contents": "x" * 100000}
+
+    async def analyze(_job, _text, runs):
+        pages_read_at_analysis.append(len(pages_read))
+        return [main.Entity("url", 0.5, [main.Mention("x", runs[0][0])])]
+
+    extractor = async_extractor(analyze)
+    extractor.open_pages = lambda document: pages()
+    job = main.DocumentJob(SimpleNamespace(id=1, data={}, page_count=60))
+    asyncio.run(extractor.extract_entities_async(job))
+    assert min(pages_read_at_analysis) < 60
+    assert len(job.entities) == len(pages_read_at_analysis)
+
+
+def test_extract_entities_async_fails_the_document_on_a_chunk_error():
+    async def analyze(_job, _text, _runs):
+        raise ValueError("bad chunk")
+
+    extractor = async_extractor(analyze)
+    extractor.open_pages = lambda document: (
+        {"page": i, "contents": "x" * 100000} for i in range(60)
+    )
+    job = main.DocumentJob(SimpleNamespace(id=1, data={}, page_count=60))
+    with pytest.raises(ValueError):
+        asyncio.run(asyncio.wait_for(extractor.extract_entities_async(job), 10))